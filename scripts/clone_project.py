@@ -1,11 +1,23 @@
 # stdlib
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path, PosixPath
-from typing import Dict
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+import copy
+import functools
+import io
+import logging
+import os
 import re
+import threading
 
 # third party
 import yaml
 
+try:
+    from yaml import CSafeLoader as _Loader, CSafeDumper as _Dumper
+except ImportError:
+    from yaml import SafeLoader as _Loader, SafeDumper as _Dumper
+
 
 # Config
 CLUSTER_TENANT_DICT = {
@@ -15,6 +27,51 @@ CLUSTER_TENANT_DICT = {
 }
 MASTER_PROJECT_NAME = 'master_project'
 DIRECTORIES = ['models', 'macros']
+MAX_WORKERS = 32
+
+logger = logging.getLogger(__name__)
+
+
+def _core_directory_path(tenant_directory: PosixPath, directory: str) -> PosixPath:
+    return tenant_directory / f'dbt_packages/{MASTER_PROJECT_NAME}/{directory}'
+
+
+def _walk_files(root: str) -> Iterator[Tuple[os.DirEntry, str]]:
+    """Yield every file below root along with its parent directories relative to root"""
+    if not os.path.isdir(root):
+        return
+    stack = [(root, '')]
+    while stack:
+        path, relative_directory = stack.pop()
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append((entry.path, os.path.join(relative_directory, entry.name)))
+                elif entry.is_file():
+                    # Symlinks to directories are neither walked nor treated as files
+                    yield entry, relative_directory
+
+
+@functools.lru_cache(maxsize=None)
+def _load_yaml(path: str):
+    """Parsed once and shared by every customer, so callers must copy before modifying"""
+    with open(path) as fp:
+        return yaml.load(fp, Loader=_Loader)
+
+
+_yaml_buffers = threading.local()
+
+
+def _dump_yaml(data, path: str, encoding: str = 'utf-8'):
+    """Dump into a buffer reused by the calling thread and write it straight to path"""
+    buffer = getattr(_yaml_buffers, 'buffer', None)
+    if buffer is None:
+        buffer = _yaml_buffers.buffer = io.BytesIO()
+    buffer.seek(0)
+    buffer.truncate()
+    yaml.dump(data, buffer, Dumper=_Dumper, sort_keys=False, encoding=encoding)
+    with buffer.getbuffer() as view, open(path, 'wb') as f:
+        f.write(view)
 
          
 class ParseDirectory:
@@ -23,92 +80,141 @@ class ParseDirectory:
         tenant_directory: PosixPath,
         directory: str,
         customer: str,
+        files: Optional[List[Tuple[os.DirEntry, str]]] = None,
+        written: Optional[Set[str]] = None,
     ):
         self.tenant_directory = tenant_directory
         self.directory = directory
         self.customer = customer
-        self.core_directory_path = tenant_directory / f'dbt_packages/{MASTER_PROJECT_NAME}/{directory}'
-        self.files = [f for f in self.core_directory_path.rglob('*') if not f.is_dir()]    
+        self.core_directory_path = _core_directory_path(tenant_directory, directory)
+        if files is None:
+            files = list(_walk_files(os.fspath(self.core_directory_path)))
+        self.files = files
+        self._mkdir_cache = set()
+        # Shared with the other customers in the tenant so customer-independent files are only written once
+        self._written = set() if written is None else written
+        
+        # Which parser handles each suffix only depends on the directory, so resolve it once
+        self._dispatch = {'.yml': SchemaParser, '.yaml': SchemaParser, '.md': DocParser}
+        if directory in ['models', 'seeds', 'snapshots']:
+            self._dispatch['.sql'] = ModelParser
+        elif directory == 'macros':
+            self._dispatch['.sql'] = MacroParser
     
+    def parsers(self) -> Iterator['FileParser']:
+        for file, relative_directory in self.files:
+            parser = self._dispatch.get(os.path.splitext(file.name)[1])
+            if parser is None:
+                logger.debug('Skipping %s.  %s not yet supported', file.name, file.path)
+                continue
+            parser = parser(
+                self.tenant_directory, file, self.directory, self.customer, relative_directory, self._mkdir_cache
+            )
+            if parser.SHARED:
+                if parser.file_path_and_file in self._written:
+                    continue
+                self._written.add(parser.file_path_and_file)
+            yield parser
+
+    def submit(self, executor: ThreadPoolExecutor) -> List[Future]:
+        """Schedule every file on executor, leaving it to the caller to wait"""
+        return [executor.submit(parser.run) for parser in self.parsers()]
+
     def run(self):
-        for file in self.files:
-            parser = None
-            if file.suffix == '.sql':
-                if self.directory in ['models', 'seeds', 'snapshots']:
-                    parser = ModelParser
-                elif self.directory == 'macros':
-                    parser = MacroParser
-            elif file.suffix == '.yml' or file.suffix == '.yaml':
-                parser = SchemaParser
-            elif file.suffix == '.md':
-                parser = DocParser
-            else:
-                print(f'Skipping {file.name}.  {file} not yet supported')
-            if parser is not None:
-                parser(self.tenant_directory, file, self.directory, self.customer).run()
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for future in self.submit(executor):
+                future.result()
 
 class FileParser:
+    # One parser is built per file, so skip the per-instance __dict__
+    __slots__ = (
+        'tenant_directory',
+        'file',
+        'directory',
+        'customer',
+        'relative_directory',
+        'mkdir_cache',
+        'file_name',
+        'file_path',
+        'file_path_and_file',
+    )
+    
+    # Set by parsers whose output doesn't depend on the customer, so one copy serves the whole tenant
+    SHARED = False
+    
     def __init__(
         self,
         tenant_directory: PosixPath,
-        file: PosixPath,
+        file: os.DirEntry,
         directory: str,
         customer: str,
+        relative_directory: str = '',
+        mkdir_cache: Optional[Set[str]] = None,
     ):
-        self.tenant_directory = tenant_directory
+        self.tenant_directory = os.fspath(tenant_directory)
         self.file = file
         self.directory = directory
         self.customer = customer
-        self.core_directory_path = tenant_directory / f'dbt_packages/{MASTER_PROJECT_NAME}/{directory}'
+        self.relative_directory = relative_directory
+        self.mkdir_cache = set() if mkdir_cache is None else mkdir_cache
+        
+        # Fixed for the lifetime of the parser, so resolve them once up front
+        self.file_name = self._get_file_name()
+        self.file_path = self._get_file_path()
+        self.file_path_and_file = os.path.join(self.file_path, self.file_name)
         
     @property
     def file_contents(self):
-        return self.file.read_text()
+        with open(self.file.path) as f:
+            return f.read()
     
-    @property
-    def file_name(self):
+    def _get_file_name(self):
         return f'{self.customer}_{self.file.name}'
     
-    @property
-    def file_path(self):
-        return self.tenant_directory.joinpath(
+    def _get_file_path(self):
+        return os.path.join(
+            self.tenant_directory,
             self.directory,
             self.customer, 
-            *self.file.relative_to(self.core_directory_path).parts[:-1]
+            self.relative_directory
         )
-        
-    @property
-    def file_path_and_file(self):
-        return self.file_path / self.file_name
+    
+    def _write(self, data: bytes):
+        with open(self.file_path_and_file, 'wb') as f:
+            f.write(data)
     
     def write_file_contents(self, encoding='utf-8'):
-        file_contents = self.file_contents
-        with self.file_path_and_file.open('w', encoding=encoding) as f:
-            f.write(file_contents)
+        self._write(self.file_contents.encode(encoding))
             
     def run(self):
-        self.file_path.mkdir(parents=True, exist_ok=True)
+        # Many files share a directory, so skip the mkdir once it's been made
+        if self.file_path not in self.mkdir_cache:
+            os.makedirs(self.file_path, exist_ok=True)
+            self.mkdir_cache.add(self.file_path)
         self.write_file_contents()
 
 
 class SchemaParser(FileParser):
-    def __init__(
-        self,
-        tenant_directory: PosixPath,
-        file: PosixPath,
-        resource: str,
-        customer: str,
-    ):
-        super().__init__(tenant_directory, file, resource, customer)
+    __slots__ = ()
+    
+    _SECTION_KEY_RE = re.compile(r'(models|seeds|snapshots|sources)\s*:')
+    _SECTION_RE = re.compile(r'(?P<section>models|seeds|snapshots|sources):\s*(#.*)?$')
+    _TOP_LEVEL_KEY_RE = re.compile(r'[A-Za-z_][\w-]*\s*:(\s|$)')
+    _ITEM_NAME_RE = re.compile(
+        r'(?P<head>\s*-(?P<space>\s+)name:\s+)(?P<name>[A-Za-z_]\w*)(?P<tail>(\s+#.*)?\s*)$'
+    )
+    _SCHEMA_RE = re.compile(
+        r"""(?P<head>\s*schema:\s+)('[^']*'|"[^"]*"|[^\s#'"|>&*!{}\[\]%@`][^#]*?)(?P<tail>(\s+#.*)?\s*)$"""
+    )
+    # Plain scalars YAML would load as something other than the literal text
+    _YAML_KEYWORDS = {'null', 'true', 'false', 'yes', 'no', 'on', 'off'}
         
-    @property
-    def file_name(self):
+    def _get_file_name(self):
         return self.file.name
     
     @property
     def file_contents(self):
-        with self.file.open() as fp:
-            data = yaml.safe_load(fp)
+        data = copy.deepcopy(_load_yaml(self.file.path))
         
         if any([i in data for i in ['models', 'seeds', 'snapshots']]):
             data = self._modify_yml_for_models(data)
@@ -129,95 +235,214 @@ class SchemaParser(FileParser):
             source['schema'] = self.customer
         return data
     
+    @staticmethod
+    def _leaves_scalar_open(line: str) -> bool:
+        """Whether a quoted scalar or flow collection on this line carries on to the next"""
+        quote = None
+        depth = 0
+        previous = ' '
+        i = 0
+        while i < len(line):
+            char = line[i]
+            if quote == '"':
+                if char == '\\':
+                    i += 1
+                elif char == '"':
+                    quote = None
+            elif quote == "'":
+                if char == "'":
+                    if line[i + 1:i + 2] == "'":
+                        i += 1
+                    else:
+                        quote = None
+            elif char == '#' and previous == ' ':
+                break
+            elif char in '\'"' and previous in ' [{,:-?':
+                quote = char
+            elif char in '[{':
+                depth += 1
+            elif char in ']}':
+                depth -= 1
+            previous = char
+            i += 1
+        return quote is not None or depth != 0
+    
+    def _modify_yml_text(self, text: str) -> Optional[str]:
+        """Rename models and repoint sources without a YAML round trip
+        
+        Only handles plain block style: unquoted top-level keys, items that start with a
+        plain `- name:` and a single line `schema:` on every source.  Returns None when it
+        finds a top-level key, item or rewritten value outside that subset, or a quoted
+        or flow value left open at the end of a line, so the caller can fall back to parsing.
+        """
+        # Files that never mention these sections, e.g. macro properties, have nothing to rewrite
+        if not any(section in text for section in ['models', 'seeds', 'snapshots', 'sources']):
+            return text
+        if '\t' in text:
+            return None
+            
+        lines = []
+        section = item_indent = key_indent = rewritten_indent = None
+        missing_schema = seen_key = False
+        for line in text.splitlines(keepends=True):
+            body = line.rstrip('\r\n')
+            eol = line[len(body):]
+            stripped = body.lstrip(' ')
+            if not stripped or stripped.startswith('#'):
+                lines.append(line)
+                continue
+                
+            # Later lines of a multi-line quoted or flow value could pass for keys, so don't guess
+            if self._leaves_scalar_open(stripped):
+                return None
+            
+            indent = len(body) - len(stripped)
+            # A deeper line straight after a rewritten value means the scalar carries on
+            if rewritten_indent is not None and indent > rewritten_indent:
+                return None
+            rewritten_indent = None
+            
+            if indent == 0 and not stripped.startswith('-'):
+                if missing_schema or not self._TOP_LEVEL_KEY_RE.match(body):
+                    return None
+                seen_key = True
+                match = self._SECTION_RE.match(body)
+                if match is None:
+                    if self._SECTION_KEY_RE.match(body):
+                        return None
+                    section = None
+                else:
+                    section = match['section']
+                item_indent = None
+                lines.append(line)
+                continue
+                
+            # Content before any top-level key, or a `---`/`-x` at the margin, isn't a plain mapping
+            if not seen_key or (indent == 0 and stripped[1:2] not in ('', ' ')):
+                return None
+            if section is None:
+                lines.append(line)
+                continue
+                
+            if item_indent is None:
+                item_indent = indent
+            if indent < item_indent:
+                return None
+            if indent == item_indent:
+                if missing_schema:
+                    return None
+                match = self._ITEM_NAME_RE.match(body)
+                if match is None or match['name'].lower() in self._YAML_KEYWORDS:
+                    return None
+                key_indent = item_indent + 1 + len(match['space'])
+                if section == 'sources':
+                    missing_schema = True
+                else:
+                    body = f"{match['head']}{self.customer}_{match['name']}{match['tail']}"
+                    rewritten_indent = key_indent
+            elif section == 'sources' and indent == key_indent and stripped.startswith('schema:'):
+                match = self._SCHEMA_RE.match(body)
+                if match is None:
+                    return None
+                body = f"{match['head']}{self.customer}{match['tail']}"
+                missing_schema = False
+                rewritten_indent = key_indent
+            lines.append(body + eol)
+            
+        if missing_schema:
+            return None
+        return ''.join(lines)
+    
     def write_file_contents(self, encoding='utf-8'):
-        data = self.file_contents
-        with self.file_path_and_file.open('w', encoding=encoding) as f:
-            yaml.dump(data, f, sort_keys=False)
+        with open(self.file.path) as fp:
+            contents = self._modify_yml_text(fp.read())
+        if contents is None:
+            _dump_yaml(self.file_contents, self.file_path_and_file, encoding)
+        else:
+            self._write(contents.encode(encoding))
 
 
 class MacroParser(FileParser):
-    def __init__(
-        self,
-        tenant_directory: PosixPath,
-        file: PosixPath,
-        resource: str,
-        customer: str,
-    ):
-        super().__init__(tenant_directory, file, resource, customer)
+    __slots__ = ()
+    
+    SHARED = True
         
-    @property
-    def file_name(self):
+    def _get_file_name(self):
         return self.file.name
         
-    @property
-    def file_path(self):
+    def _get_file_path(self):
         """Each tenant can leverage the same macro"""
-        return self.tenant_directory.joinpath(
+        return os.path.join(
+            self.tenant_directory,
             self.directory, 
-            *self.file.relative_to(self.core_directory_path).parts[:-1]
+            self.relative_directory
         )
         
         
 class DocParser(MacroParser):
-    def __init__(
-        self,
-        tenant_directory: PosixPath,
-        file: PosixPath,
-        resource: str,
-        customer: str,
-    ):
-        super().__init__(tenant_directory, file, resource, customer)
-        
-    @property
-    def file_path(self):
+    __slots__ = ()
+    
+    def _get_file_path(self):
         """Each tenant can leverage the same docs"""
-        return self.tenant_directory.joinpath(self.directory, 'shared')
+        return os.path.join(self.tenant_directory, self.directory, 'shared')
 
 
 class ModelParser(FileParser):
+    __slots__ = ('_required_configs',)
+    
     def __init__(
         self,
         tenant_directory: PosixPath,
-        file: PosixPath,
-        resource: str,
+        file: os.DirEntry,
+        directory: str,
         customer: str,
+        relative_directory: str = '',
+        mkdir_cache: Optional[Set[str]] = None,
     ):
-        super().__init__(tenant_directory, file, resource, customer)
+        super().__init__(tenant_directory, file, directory, customer, relative_directory, mkdir_cache)
+        self._required_configs = f"schema='{customer}', alias='{os.path.splitext(file.name)[0]}'"
         
-    REF_SINGLE_QUOTE = "(?<=ref\(').*?(?='\))"
-    REF_DOUBLE_QUOTE = '(?<=ref\(").*?(?="\))'
-    CONFIG_SEARCH = '(?<=config\()[\s\S]*?(?=\))'
-     
-    @property
-    def REQUIRED_CONFIGS(self):
-        return f"schema='{self.customer}', alias='{self.file.stem}'"
+    # refs and configs are both rewritten in a single scan over the SQL
+    REF_SEARCH = re.compile(r"""(?P<head>ref\(\s*(?P<quote>['"]))(?P<name>.*?)(?P<tail>(?P=quote)\s*\))""")
+    SQL_SEARCH = re.compile(rf'{REF_SEARCH.pattern}|config\((?P<configs>(?s:.)*?)\)')
 
-    def _prefix_customer(self, match_obj):
-        if match_obj.group() is not None:
-            return f'{self.customer}_{match_obj.group()}'
-        
-    def _append_required_configs(self, match_obj):
-        if match_obj.group() is not None:
-            return f"{match_obj.group()}, {self.REQUIRED_CONFIGS}"
-        
-    def _modify_refs(self, sql: str):
-        sql = re.sub(self.REF_SINGLE_QUOTE, self._prefix_customer, sql)
-        sql = re.sub(self.REF_DOUBLE_QUOTE, self._prefix_customer, sql)        
-        return sql
+    def _modify_match(self, match_obj):
+        if match_obj['name'] is not None:
+            return f"{match_obj['head']}{self.customer}_{match_obj['name']}{match_obj['tail']}"
+        configs = f"config({match_obj['configs']}, {self._required_configs})"
+        # The config match swallows any ref() inside it (e.g. in a hook), so prefix those as well.  Unlike the old
+        # whole-file ref pass, a ref can't run past the end of the config match: when its closing quote first
+        # appears after that point, a later ref may get the prefix instead
+        if 'ref(' in configs:
+            configs = self.REF_SEARCH.sub(self._modify_match, configs)
+        return configs
 
-    def _modify_config(self, sql: str):
-        sql = re.sub(self.CONFIG_SEARCH, self._append_required_configs, sql)
-        if not re.findall(self.REQUIRED_CONFIGS, sql):
-            sql = f"{{{{ config({self.REQUIRED_CONFIGS}) }}}}\n\n{sql}"
+    def _modify_sql(self, sql: str):
+        sql = self.SQL_SEARCH.sub(self._modify_match, sql)
+        if self._required_configs not in sql:
+            sql = f"{{{{ config({self._required_configs}) }}}}\n\n{sql}"
         
         return sql
 
     @property
     def file_contents(self):
-        sql = self.file.read_text()
-        sql = self._modify_config(sql)
-        sql = self._modify_refs(sql)
-        return sql
+        with open(self.file.path) as f:
+            return self._modify_sql(f.read())
+
+
+def _parse_tenant_directory(tenant_directory: PosixPath, directory: str, customers: List[str]):
+    """Parse one core directory for every customer in the tenant, files fanned out over a thread pool"""
+    # The core project is the same for every customer, so only walk it once
+    files = list(_walk_files(os.fspath(_core_directory_path(tenant_directory, directory))))
+    written = set()
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = []
+        for customer in customers:
+            futures.extend(
+                ParseDirectory(tenant_directory, directory, customer, files=files, written=written).submit(executor)
+            )
+        for future in futures:
+            future.result()
 
 
 if __name__ == '__main__':
@@ -225,15 +450,17 @@ if __name__ == '__main__':
 
     tenant_directories = [d for d in path.iterdir() if d.is_dir() and 'tenants' in d.name]
 
-    for tenant_directory in tenant_directories:
-        
-        # Retrieve the customers in the environment    
-        customers_in_environment = CLUSTER_TENANT_DICT[tenant_directory.name]
-        for customer in customers_in_environment:
-            
-            for directory in DIRECTORIES:
-            
-                ParseDirectory(tenant_directory, directory, customer).run()
+    # Schema and model rewrites are CPU bound, so give each tenant directory its own process to sidestep the GIL
+    with ProcessPoolExecutor() as executor:
+        futures = [
+            executor.submit(
+                _parse_tenant_directory, tenant_directory, directory, CLUSTER_TENANT_DICT[tenant_directory.name]
+            )
+            for tenant_directory in tenant_directories
+            for directory in DIRECTORIES
+        ]
+        for future in futures:
+            future.result()
 
 
 """
@@ -247,5 +474,8 @@ TODO: Pinning to a release is great and all as far as the code you return, but t
       to my core models, but I build them in different tables.  That way I ensure proper deprecation.)  HOW CAN I DO THIS PROGRAMMATICALLY?
 TODO: Change the core project to inclue the config piece.  The before/after is a bit hacky (P1)
 TODO: How do exposures work in this world?  Do they?  (P3)
+TODO: File I/O already fans out over a single ThreadPoolExecutor.  aiofiles would only push the same reads/writes onto
+      a thread pool, so it isn't worth the dependency.  If core ever gets big enough for syscall latency to matter, look at
+      batching the reads/writes through io_uring on Linux (P3)
 
 """
\ No newline at end of file